@@ -1,8 +1,10 @@
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List
 
 import networkx as nx
+import numpy as np
 
 from airway.util.config_parsers import parse_array_encoding, parse_classification_config
 from airway.util.util import get_data_paths_from_args, get_ignored_patients
@@ -11,9 +13,10 @@ from airway.util.util import get_data_paths_from_args, get_ignored_patients
 def get_input():
     output_data_path, tree_input_path = get_data_paths_from_args()
     classification_config = parse_classification_config()
-    trees: List[nx.Graph] = []
-    for tree_path in Path(tree_input_path).glob("*/tree.graphml"):
-        trees.append(nx.read_graphml(tree_path))
+    tree_paths = list(Path(tree_input_path).glob("*/tree.graphml"))
+    # Parsing graphml is CPU bound, hence load the trees in parallel processes
+    with ProcessPoolExecutor() as executor:
+        trees: List[nx.Graph] = list(executor.map(nx.read_graphml, tree_paths))
     return output_data_path, trees, classification_config
 
 
@@ -24,23 +27,27 @@ def main():
     lobe_encoding = {k: v for k, v in encoding.items() if "Lobe" in k}
     decoding = dict(zip(encoding.values(), encoding.keys()))
 
-    no_ignored = []
-    with_ignored = []
+    no_ignored: List[np.ndarray] = []
+    with_ignored: List[np.ndarray] = []
     for index, tree in enumerate(trees, 1):
-        for node_id in tree.nodes:
-            node = tree.nodes[node_id]
-            if node["split_classification"] in lobe_encoding:
-                correctly_classified = node["lobe"] == encoding[node["split_classification"]]
-                if str(tree.graph["patient"]) not in ignored_patients:
-                    no_ignored.append(correctly_classified)
-                    if not correctly_classified:
-                        print(f"Patient {tree.graph['patient']}")
-                        print(f"Mistaken {decoding[node['lobe']]} (Synapse) for {node['split_classification']}\n")
-                with_ignored.append(correctly_classified)
-
-    def show_stats(lis: List[bool]):
-        s = sum(lis)
-        t = len(lis)
+        nodes = [node for node in tree.nodes.values() if node["split_classification"] in lobe_encoding]
+        lobes = np.fromiter((node["lobe"] for node in nodes), dtype=np.int32, count=len(nodes))
+        expected = np.fromiter(
+            (encoding[node["split_classification"]] for node in nodes), dtype=np.int32, count=len(nodes)
+        )
+        correctly_classified = lobes == expected
+        if str(tree.graph["patient"]) not in ignored_patients:
+            no_ignored.append(correctly_classified)
+            for node_index in np.flatnonzero(~correctly_classified):
+                node = nodes[node_index]
+                print(f"Patient {tree.graph['patient']}")
+                print(f"Mistaken {decoding[node['lobe']]} (Synapse) for {node['split_classification']}\n")
+        with_ignored.append(correctly_classified)
+
+    def show_stats(lis: List[np.ndarray]):
+        correct = np.concatenate(lis)
+        s = np.count_nonzero(correct)
+        t = len(correct)
         print(f"{s}/{t} = {s / t:%}")
 
     print("Without ignored patients:")
@@ -31,11 +31,17 @@ above 1.5, possibly only 1.0.
 
 import os
 import math
+import heapq
+from collections import Counter
+from functools import partial
+from typing import Dict, List, NamedTuple
 
 import networkx as nx
+import numpy as np
 
 from airway.tree_extraction.compose_tree import set_attribute_to_node
 from airway.tree_extraction.compose_tree import set_level
+from airway.util.config_parsers import get_cache_path, load_with_cache, write_cache
 from airway.util.util import get_data_paths_from_args
 
 # ============================================================================
@@ -52,7 +58,8 @@ DIAMETER_TO_WEIGHT_RATIO = 0.85
 
 
 def calc_diameter(area):
-    return math.sqrt(4 * area / math.pi)
+    """Works for single areas as well as arrays of areas"""
+    return np.sqrt(4 * area / np.pi)
 
 
 def distance(graph, node_a, node_b):
@@ -68,18 +75,246 @@ def distance(graph, node_a, node_b):
 
 
 def load_graph(path):
-    """Loads graph from given path"""
-    return nx.read_graphml(path)
+    """Loads graph from given path, using the pickled graph written next to it
+    by `save_graph` if the GraphML file has not changed since. Nothing is written,
+    as the path usually is in the input directory of the calling stage
+    """
+    return load_with_cache(path, nx.read_graphml, write=False)
+
+
+def save_graph(graph, path):
+    """Writes graph as GraphML for the other scripts, and pickled for `load_graph`"""
+    nx.write_graphml(graph, path)
+    write_cache(get_cache_path(path), path.stat().st_mtime_ns, graph)
+
+
+def get_adjacency_arrays(graph):
+    """Returns the nodes of the graph, a dict mapping each node to its index and the
+    adjacency of the graph in CSR form, i.e. the neighbors of node i are
+    indices[indptr[i]:indptr[i+1]] in the same order as in the graph
+    """
+    nodes = list(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(neighbors) for _, neighbors in graph.adjacency()])
+    indices = np.fromiter(
+        (index[neighbor] for _, neighbors in graph.adjacency() for neighbor in neighbors),
+        dtype=np.int64,
+        count=indptr[-1],
+    )
+    return nodes, index, indptr, indices
+
+
+def bfs(indptr, indices, root):
+    """Runs a BFS over the CSR adjacency starting at the `root` index
+
+    Each depth is expanded at once with NumPy and visited nodes are tracked in a
+    boolean array. Returns the node indices in BFS order (same order as
+    nx.bfs_edges) and the parent and depth of each node index.
+    """
+    node_count = len(indptr) - 1
+    visited = np.zeros(node_count, dtype=bool)
+    parent = np.full(node_count, -1, dtype=np.int64)
+    depth = np.full(node_count, -1, dtype=np.int64)
+    visited[root] = True
+    depth[root] = 0
+    frontier = np.array([root], dtype=np.int64)
+    order = [frontier]
+    curr_depth = 0
+    while frontier.size:
+        curr_depth += 1
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        # Positions in `indices` of the neighbors of all frontier nodes, i.e. the
+        # concatenated ranges indptr[node]:indptr[node + 1] of the frontier
+        positions = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        neighbors = indices[positions]
+        sources = np.repeat(frontier, counts)
+        unvisited = ~visited[neighbors]
+        neighbors, sources = neighbors[unvisited], sources[unvisited]
+        # Only keep the first occurrence if several nodes of the frontier share a neighbor
+        first_occurrences = np.sort(np.unique(neighbors, return_index=True)[1])
+        frontier = neighbors[first_occurrences]
+        visited[frontier] = True
+        parent[frontier] = sources[first_occurrences]
+        depth[frontier] = curr_depth
+        order.append(frontier)
+    return np.concatenate(order), parent, depth
+
+
+def get_bfs_maps(graph):
+    """Returns the BFS successors and predecessors dicts starting at the root
+
+    These are passed to the functions below instead of each of them running
+    its own BFS. They are kept up to date by `merge_edges` and `remove_nodes`.
+    """
+    nodes, index, indptr, indices = get_adjacency_arrays(graph)
+    order, parent, _ = bfs(indptr, indices, index["0"])
+    # Same as nx.bfs_successors, the root is kept even without successors
+    successors = {"0": []}
+    predecessors = {}
+    for node, node_parent in zip(order[1:].tolist(), parent[order[1:]].tolist()):
+        successors.setdefault(nodes[node_parent], []).append(nodes[node])
+        predecessors[nodes[node]] = nodes[node_parent]
+    return successors, predecessors
+
+
+class TreeArrays(NamedTuple):
+    """Structure of arrays representation of the tree, see `get_tree_arrays`"""
+
+    nodes: List[str]
+    index: Dict[str, int]
+    parent: np.ndarray
+    depth: np.ndarray
+    children_indptr: np.ndarray
+    subtree_size: np.ndarray
+    post_order: np.ndarray
+    level: np.ndarray
+
+
+def get_tree_arrays(graph):
+    """Numbers the nodes in BFS order starting at the root and returns the tree as arrays
+
+    Node i has the id nodes[i], its parent is parent[i] (-1 for the root). Due to
+    the BFS order the children of each node and the nodes of each depth are
+    contiguous, the children of node i are children_indptr[i] to children_indptr[i+1]
+    (exclusive). subtree_size[i] counts node i and all of its successors, post_order[i]
+    is the position of node i in a depth-first post-order traversal. The levels are
+    copied, hence they are only a snapshot of the graph and the tree structure must
+    not change while these arrays are used. The lobes change while recoloring, so
+    these are always read from the graph with `get_lobes`.
+    """
+    graph_nodes, graph_index, indptr, indices = get_adjacency_arrays(graph)
+    order, graph_parent, graph_depth = bfs(indptr, indices, graph_index["0"])
+    nodes = [graph_nodes[node] for node in order.tolist()]
+    index = {node: i for i, node in enumerate(nodes)}
+
+    # Renumber from the graph order to the BFS order
+    bfs_index = np.empty(len(nodes), dtype=np.int64)
+    bfs_index[order] = np.arange(len(nodes))
+    parent = np.full(len(nodes), -1, dtype=np.int32)
+    parent[1:] = bfs_index[graph_parent[order[1:]]]
+    depth = graph_depth[order].astype(np.int32)
+
+    # The root is the only node which is not a child
+    children_indptr = np.ones(len(nodes) + 1, dtype=np.int64)
+    children_indptr[1:] += np.cumsum(np.bincount(parent[1:], minlength=len(nodes)))
+
+    # Going from the deepest level up, each node adds its subtree size to its parent
+    depth_slices = get_depth_slices(depth)
+    subtree_size = np.ones(len(nodes), dtype=np.int64)
+    for depth_slice in reversed(depth_slices[1:]):
+        np.add.at(subtree_size, parent[depth_slice], subtree_size[depth_slice])
+
+    # Going from the top down, each subtree starts in the post-order after its
+    # parent's start and the subtrees of its previous siblings
+    post_order_start = np.zeros(len(nodes), dtype=np.int64)
+    for depth_slice in depth_slices[1:]:
+        parents = parent[depth_slice]
+        previous_sizes = np.cumsum(subtree_size[depth_slice]) - subtree_size[depth_slice]
+        first_sibling = children_indptr[parents] - depth_slice.start
+        post_order_start[depth_slice] = post_order_start[parents] + previous_sizes - previous_sizes[first_sibling]
+    post_order = post_order_start + subtree_size - 1
+
+    return TreeArrays(
+        nodes=nodes,
+        index=index,
+        parent=parent,
+        depth=depth,
+        children_indptr=children_indptr,
+        subtree_size=subtree_size,
+        post_order=post_order,
+        level=np.array([graph.nodes[node]["level"] for node in nodes], dtype=np.int32),
+    )
+
+
+def get_lobes(graph, nodes):
+    """Returns the current lobes of the given nodes as an array"""
+    return np.array([graph.nodes[node]["lobe"] for node in nodes], dtype=np.int64)
+
+
+def get_subtree_lobe_counts(tree, lobes):
+    """Returns an array where [i, lobe] is the number of nodes of the subtree of
+    node i (including itself) which are in `lobe`, neutral nodes are not counted
+
+    `lobes` has to be in the same order as the nodes of `tree`.
+    """
+    counts = np.zeros((len(tree.nodes), lobes.max(initial=0) + 1), dtype=np.int64)
+    counts[np.arange(len(tree.nodes)), lobes] = 1
+    counts[:, 0] = 0
+    # Going from the deepest level up, each node adds its counts to its parent
+    for depth_slice in reversed(get_depth_slices(tree.depth)[1:]):
+        np.add.at(counts, tree.parent[depth_slice], counts[depth_slice])
+    return counts
 
 
-def remove_nodes(graph, nodes_to_be_removed):
-    """Removes given nodes from graph"""
+def get_subtree_lobe_first_positions(tree, lobes, lobe_counts):
+    """Returns an array where [i, lobe] is the earliest post-order position in the
+    subtree of node i of a node in `lobe`
+
+    This is the order in which the lobes are first encountered when traversing
+    the subtree in post-order, which is used to break ties between lobes.
+    """
+    first_positions = np.full(lobe_counts.shape, len(tree.nodes), dtype=np.int64)
+    first_positions[np.arange(len(tree.nodes)), lobes] = tree.post_order
+    first_positions[:, 0] = len(tree.nodes)
+    for depth_slice in reversed(get_depth_slices(tree.depth)[1:]):
+        np.minimum.at(first_positions, tree.parent[depth_slice], first_positions[depth_slice])
+    return first_positions
+
+
+def get_ordered_lobe_counts(lobe_counts, first_positions):
+    """Returns a dict with the count of each lobe in the order they were encountered"""
+    lobes = np.flatnonzero(lobe_counts)
+    lobes = lobes[np.argsort(first_positions[lobes], kind="stable")]
+    return {lobe: int(lobe_counts[lobe]) for lobe in lobes.tolist()}
+
+
+def get_depth_slices(depth):
+    """Returns a slice for each depth of the tree with the node indices at that depth,
+    `depth` has to be sorted as in the BFS order of `TreeArrays`
+    """
+    bounds = np.searchsorted(depth, np.arange(depth[-1] + 2))
+    return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def remove_nodes(graph, successors, predecessors, nodes_to_be_removed):
+    """Removes given nodes from graph and from the BFS successors/predecessors,
+    returns the number of removed nodes
+    """
     nodes_removed = len(nodes_to_be_removed)
-    nodes_before = nx.number_of_nodes(graph)
+    nodes_before = len(graph)
     nodes_remaining = nodes_before - nodes_removed
+    graph.remove_nodes_from(nodes_to_be_removed)
     for node in nodes_to_be_removed:
-        graph.remove_node(node)
+        predecessor = predecessors.pop(node)
+        successors[predecessor].remove(node)
+        # Same as nx.bfs_successors, the root is kept even without successors
+        if not successors[predecessor] and predecessor != "0":
+            del successors[predecessor]
+        successors.pop(node, None)
     print(f"Removed {nodes_removed} nodes ({nodes_before} -> {nodes_remaining}))")
+    return nodes_removed
+
+
+def summarize_group_sizes(group_sizes):
+    """Returns how many group sizes the whitespace separated string contains and their sum"""
+    group_sizes = group_sizes.split()
+    return len(group_sizes), sum(map(int, group_sizes))
+
+
+def get_group_sizes_summary(graph, successors):
+    """Parses the group size string of each edge once and returns a dict mapping
+    each (predecessor, node) edge to how many group sizes there are and their sum,
+    so these do not have to be parsed again every time an edge is checked
+
+    These are kept out of the edge attributes, as they are not part of the output.
+    """
+    return {
+        (predecessor, node): summarize_group_sizes(graph[predecessor][node]["group_sizes"])
+        for predecessor, nodes in successors.items()
+        for node in nodes
+    }
 
 
 def combine_group_sizes(graph, node_pre, node, node_suc):
@@ -89,73 +324,52 @@ def combine_group_sizes(graph, node_pre, node, node_suc):
     return e1["group_sizes"] + " " + e2["group_sizes"]
 
 
-def merge_edges(graph, predecessor, node, successor):
-    """Correctly merges 2 edges"""
-    graph.add_edge(
-        predecessor,
-        successor,
-        weight=distance(graph, predecessor, successor),
-        group_sizes=combine_group_sizes(graph, predecessor, node, successor),
-    )
-
-
-def assign_children_count(graph):
+def merge_edges(graph, successors, predecessors, group_sizes_summary, edges_to_be_merged):
+    """Correctly merges each (predecessor, node, successor) pair of edges, all
+    `node`s have to be removed afterwards
+    """
+    for predecessor, node, successor in edges_to_be_merged:
+        graph.add_edge(
+            predecessor,
+            successor,
+            weight=distance(graph, predecessor, successor),
+            group_sizes=combine_group_sizes(graph, predecessor, node, successor),
+        )
+        # The string is only kept for the output, the count and sum are added up directly
+        count_pre, sum_pre = group_sizes_summary[predecessor, node]
+        count_suc, sum_suc = group_sizes_summary[node, successor]
+        group_sizes_summary[predecessor, successor] = (count_pre + count_suc, sum_pre + sum_suc)
+        successors[predecessor].append(successor)
+        predecessors[successor] = predecessor
+
+
+def assign_children_count(graph, tree):
     """Assigns each node a number which specifies how many children it has"""
 
-    successors = dict(nx.bfs_successors(graph, "0"))
-    all_successors = {}
-
-    def successor_count(curr_node="0"):
-        if curr_node in successors:
-            count = sum([successor_count(succ) for succ in successors[curr_node]])
-        else:
-            count = 0
-        all_successors[curr_node] = count
-        return count + 1
-
-    successor_count()
-    for node, count in all_successors.items():
+    for node, count in zip(tree.nodes, (tree.subtree_size - 1).tolist()):
         graph.nodes[node]["successor_count"] = count
 
 
-def get_successor_lobes(graph, return_count=False):
-    """Returns a dict with each node and a set with all it's successors lobes"""
-
-    successors = dict(nx.bfs_successors(graph, "0"))
-    all_successors = {}
-
-    def successor_lobes(curr_node="0"):
-        lobes = {}
-        if curr_node in successors:
-            for succ in successors[curr_node]:
-                for key, occ in successor_lobes(succ).items():
-                    lobes[key] = lobes.get(key, 0) + occ
-        all_successors[curr_node] = lobes
-        curr_lobe = graph.nodes[curr_node]["lobe"]
-        if curr_lobe != 0:
-            lobes[curr_lobe] = lobes.get(curr_lobe, 0) + 1
-        return lobes
-
-    successor_lobes()
-    if return_count:
-        return all_successors
-    else:
-        return {lobe: set(occ.keys()) for lobe, occ in all_successors.items()}
+def get_nodes_in_post_order(tree):
+    """Returns the nodes of the tree in post-order, the subtree of node i is then
+    the slice returned by `get_subtree_slice`
+    """
+    nodes_in_post_order = [""] * len(tree.nodes)
+    for node, position in zip(tree.nodes, tree.post_order.tolist()):
+        nodes_in_post_order[position] = node
+    return nodes_in_post_order
 
 
-def set_attribute_recursively(graph, node, attribute_name, value):
-    """Traverses the tree from the root node and starting at `node`
-    sets all `attribute_name` to `value`
-    """
-    successors = dict(nx.bfs_successors(graph, "0"))
+def get_subtree_slice(tree, index):
+    """Returns the slice of the post-order with node `index` and all its successors"""
+    end = int(tree.post_order[index]) + 1
+    return slice(end - int(tree.subtree_size[index]), end)
 
-    def rec_traverse(curr_node):
-        graph.nodes[curr_node][attribute_name] = value
-        if curr_node in successors:
-            for succ in successors[curr_node]:
-                rec_traverse(succ)
 
-    rec_traverse(node)
+def set_attribute_for_nodes(graph, nodes, attribute_name, value):
+    """Sets `attribute_name` to `value` for all given nodes"""
+    for node in nodes:
+        graph.nodes[node][attribute_name] = value
 
 
 # ============================================================================
@@ -163,67 +377,68 @@ def set_attribute_recursively(graph, node, attribute_name, value):
 # ============================================================================
 
 
-def remove_minor_edges(graph):
+def remove_minor_edges(graph, successors, predecessors, group_sizes_summary):
     """Removes edges which have no children and are very short (see constant)"""
-    has_successors = {s[0] for s in nx.bfs_successors(graph, "0")}
     nodes_to_be_removed = []
-    for fr, to in nx.bfs_edges(graph, "0"):
-        if to not in has_successors:
+    for fr, to in [(fr, to) for fr, tos in successors.items() for to in tos]:
+        if to not in successors:
 
             # More naive way of checking
             # if graph[fr][to]['group_sizes'].count(' ') < REMOVE_IF_GROUP_SIZE_LESS_THAN:
 
             # Alternative way of checking, compares the current diameter with edge length
             node_diameter = graph.nodes.data()[fr]["group_size"]
-            avg_edge_length = graph[fr][to]["group_sizes"].count(" ")
+            avg_edge_length = group_sizes_summary[fr, to][0] - 1
             if avg_edge_length - node_diameter < REMOVE_IF_GROUP_SIZE_LESS_THAN:
                 nodes_to_be_removed.append(to)
-    remove_nodes(graph, nodes_to_be_removed)
+    return remove_nodes(graph, successors, predecessors, nodes_to_be_removed)
 
 
-def straighten_edges(graph):
+def straighten_edges(graph, successors, predecessors, group_sizes_summary):
     """Merges all nodes which only have 1 child with their parent"""
-    predecessors = dict(nx.bfs_predecessors(graph, "0"))
-    only_single_successor = [(n, *s) for n, s in nx.bfs_successors(graph, "0") if len(s) == 1]
+    only_single_successor = [(n, *s) for n, s in successors.items() if len(s) == 1]
     nodes_to_be_removed = []
+    edges_to_be_merged = []
     cant_be_removed = {"0"}
     for node, successor in only_single_successor:
         if node not in cant_be_removed:
             predecessor = predecessors[node]
             nodes_to_be_removed.append(node)
-            merge_edges(graph, predecessor, node, successor)
+            edges_to_be_merged.append((predecessor, node, successor))
             cant_be_removed.add(successor)
-    remove_nodes(graph, nodes_to_be_removed)
+    merge_edges(graph, successors, predecessors, group_sizes_summary, edges_to_be_merged)
+    return remove_nodes(graph, successors, predecessors, nodes_to_be_removed)
 
 
-def merge_close_nodes(graph):
+def merge_close_nodes(graph, successors, predecessors, group_sizes_summary):
     """Merges nodes when they are really close to each other"""
-    has_successors = dict(nx.bfs_successors(graph, "0"))
     nodes_to_be_removed = []
     edges_to_be_merged = []
     cant_be_removed = {"0"}
-    for predecessor, node in nx.bfs_edges(graph, "0"):
+    edges = [(fr, to) for fr, tos in successors.items() for to in tos]
+    edges_data = [graph[fr][to] for fr, to in edges]
+    weights = np.array([data["weight"] for data in edges_data], dtype=np.float64)
+    summaries = np.array([group_sizes_summary[edge] for edge in edges], dtype=np.float64).reshape(-1, 2)
+    group_sizes_counts, group_sizes_sums = summaries.T
+    diameters = calc_diameter(group_sizes_sums / group_sizes_counts)
+    is_close = weights < diameters * DIAMETER_TO_WEIGHT_RATIO
+    for edge_index in np.flatnonzero(is_close).tolist():
+        predecessor, node = edges[edge_index]
         if node not in cant_be_removed:
-            curr = graph[predecessor][node]
-            nums = list(map(int, curr["group_sizes"].split()))
-            weight = curr["weight"]
-            diameter = calc_diameter(sum(nums) / len(nums))
-            if weight < diameter * DIAMETER_TO_WEIGHT_RATIO:
-                if node in has_successors:
-                    for successor in has_successors[node]:
-                        cant_be_removed.add(successor)
-                        edges_to_be_merged.append((graph, predecessor, node, successor))
-                nodes_to_be_removed.append(node)
-                print(f"Merging: weight: {weight:.2f}, average: {diameter:.2f}", end=" -> ")
-                print(curr)
-    for edge_merge in edges_to_be_merged:
-        merge_edges(*edge_merge)
-    remove_nodes(graph, nodes_to_be_removed)
-
-
-def remove_children_without_children(graph):
+            curr = edges_data[edge_index]
+            if node in successors:
+                for successor in successors[node]:
+                    cant_be_removed.add(successor)
+                    edges_to_be_merged.append((predecessor, node, successor))
+            nodes_to_be_removed.append(node)
+            print(f"Merging: weight: {curr['weight']:.2f}, average: {diameters[edge_index]:.2f}", end=" -> ")
+            print(curr)
+    merge_edges(graph, successors, predecessors, group_sizes_summary, edges_to_be_merged)
+    return remove_nodes(graph, successors, predecessors, nodes_to_be_removed)
+
+
+def remove_children_without_children(graph, successors, predecessors):
     """Remove all nodes which don't have any children in the first 4 layers"""
-    successors = dict(nx.bfs_successors(graph, "0"))
     nodes_to_check = set("0")
     for _ in range(3):
         new_nodes = set()
@@ -242,7 +457,44 @@ def remove_children_without_children(graph):
 
     if nodes_to_be_removed:
         print(f"Found {len(nodes_to_be_removed)} in top 3 layers to remove")
-    remove_nodes(graph, nodes_to_be_removed)
+    return remove_nodes(graph, successors, predecessors, nodes_to_be_removed)
+
+
+def process_removals(graph, successors, predecessors, group_sizes_summary):
+    """Runs all node removal methods repeatedly until none of them removes any more
+    nodes, sharing the same BFS successors and predecessors between them
+
+    The methods still run one after another, since each of them depends on
+    the nodes removed by the previous ones. A method is skipped if the tree has
+    not changed since it last ran without removing anything, since it would not
+    remove anything this time either.
+    """
+    removal_methods = [
+        partial(remove_minor_edges, graph, successors, predecessors, group_sizes_summary),
+        partial(straighten_edges, graph, successors, predecessors, group_sizes_summary),
+        partial(merge_close_nodes, graph, successors, predecessors, group_sizes_summary),
+        partial(remove_children_without_children, graph, successors, predecessors),
+    ]
+    # Incremented on each change to the tree, stored per method when it removed nothing
+    tree_version = 0
+    unchanged_at_version = [None] * len(removal_methods)
+    iteration = 0
+    while True:
+        print(f"=== Iteration {iteration} ===")
+
+        nodes_removed = 0
+        for method_index, removal_method in enumerate(removal_methods):
+            if unchanged_at_version[method_index] != tree_version:
+                removed = removal_method()
+                if removed:
+                    tree_version += 1
+                    nodes_removed += removed
+                else:
+                    unchanged_at_version[method_index] = tree_version
+
+        iteration += 1
+        if nodes_removed == 0:
+            break
 
 
 # ============================================================================
@@ -250,106 +502,145 @@ def remove_children_without_children(graph):
 # ============================================================================
 
 
-def recolor_if_all_adjacent_have_different_color(graph):
+def recolor_if_all_adjacent_have_different_color(graph, adjacency):
     """Iterates over each node and recolors if _all_ adjacent nodes have a
     different color
+
+    The nodes which could be recolored are found with NumPy first, then only these
+    are checked one after another in the order of the graph. Whenever a node is
+    recolored its later neighbors are checked as well, as they see the new color.
+    Returns whether any node was recolored.
     """
-    root_successors = get_successor_lobes(graph, return_count=True)["0"]
-    for node in graph.nodes():
-        n = graph.nodes
-        if n[node]["lobe"] != 0:
-            adjacent_lobes = {n[adj]["lobe"] for adj in graph[node] if n[adj]["lobe"] != 0}
-            if len(adjacent_lobes) == 1:
-                surrounding_lobe = list(adjacent_lobes)[0]
-                if surrounding_lobe != n[node]["lobe"]:
-                    if root_successors[n[node]["lobe"]] > 1:
-                        print(f"Recoloring node {node} from {n[node]['lobe']} to {surrounding_lobe}")
-                        n[node]["lobe"] = surrounding_lobe
-                        root_successors[n[node]["lobe"]] -= 1
-                        root_successors[surrounding_lobe] += 1
-
-
-def possibly_make_neutral_above_level_4(graph):
+    nodes, _, indptr, indices = adjacency
+    lobes = get_lobes(graph, nodes)
+    if len(indices) == 0:
+        return False
+    # Count of each lobe in the entire tree, a lobe is never recolored entirely
+    lobe_count = np.bincount(lobes)
+    lobe_count[0] = 0
+
+    # A node is a candidate if its non-neutral adjacent nodes have exactly one color,
+    # i.e. the minimum and maximum of these are the same, and it's not the node's own
+    adjacent_lobes = lobes[indices]
+    neutral = adjacent_lobes == 0
+    min_adjacent = np.minimum.reduceat(np.where(neutral, np.iinfo(np.int64).max, adjacent_lobes), indptr[:-1])
+    max_adjacent = np.maximum.reduceat(np.where(neutral, -1, adjacent_lobes), indptr[:-1])
+    candidates = (np.diff(indptr) > 0) & (lobes != 0) & (min_adjacent == max_adjacent) & (min_adjacent != lobes)
+    candidates &= lobe_count[lobes] > 1
+
+    to_check = np.flatnonzero(candidates).tolist()
+    queued = set(to_check)
+    recolored = False
+    while to_check:
+        i = heapq.heappop(to_check)
+        adjacent = indices[indptr[i] : indptr[i + 1]].tolist()
+        adjacent_lobes = {lobes[adj] for adj in adjacent if lobes[adj] != 0}
+        if lobes[i] != 0 and len(adjacent_lobes) == 1:
+            surrounding_lobe = int(adjacent_lobes.pop())
+            if surrounding_lobe != lobes[i] and lobe_count[lobes[i]] > 1:
+                print(f"Recoloring node {nodes[i]} from {lobes[i]} to {surrounding_lobe}")
+                graph.nodes[nodes[i]]["lobe"] = surrounding_lobe
+                lobes[i] = surrounding_lobe
+                recolored = True
+                for adj in adjacent:
+                    if adj > i and adj not in queued:
+                        queued.add(adj)
+                        heapq.heappush(to_check, adj)
+    return recolored
+
+
+def possibly_make_neutral_above_level_4(graph, tree):
     """Recolors the highest node which only has right middle lobe
     and right lower lobe nodes below it
     """
-    for node, successor_lobes in get_successor_lobes(graph).items():
-        if graph.nodes[node]["level"] <= 4 and graph.nodes[node]["lobe"] != 0:
-            if len(successor_lobes) > 1:
-                print(f"Making node {node} neutral since it's successors are: {successor_lobes}")
-                graph.nodes[node]["lobe"] = 0
-        # if 4 in successor_lobes and 5 in successor_lobes:
-        # print(node, successor_lobes)
+    lobes = get_lobes(graph, tree.nodes)
+    lobe_counts = get_subtree_lobe_counts(tree, lobes)
+    several_successor_lobes = np.count_nonzero(lobe_counts, axis=1) > 1
+    for i in np.flatnonzero((tree.level <= 4) & (lobes != 0) & several_successor_lobes).tolist():
+        successor_lobes = set(np.flatnonzero(lobe_counts[i]).tolist())
+        print(f"Making node {tree.nodes[i]} neutral since it's successors are: {successor_lobes}")
+        graph.nodes[tree.nodes[i]]["lobe"] = 0
 
 
-def recolor_if_successors_all_different_color(graph):
+def recolor_if_successors_all_different_color(graph, tree):
     """Iterates over each node and recolor a node of all it's successors
-    have a different color
+    have a different color. Returns whether any node was recolored.
     """
-    for node, successor_lobes in get_successor_lobes(graph).items():
-        curr_lobe = graph.nodes[node]["lobe"]
-        if curr_lobe != 0:
-            if len(successor_lobes) == 1 and curr_lobe not in successor_lobes:
-                c = list(successor_lobes)[0]
-                graph.nodes[node]["lobe"] = c
-                print(f"Recoloring node {node} from {curr_lobe} to {c}")
-
-
-def add_new_parent_for_lobe(graph):
+    lobes = get_lobes(graph, tree.nodes)
+    lobe_counts = get_subtree_lobe_counts(tree, lobes)
+    single_successor_lobe = np.count_nonzero(lobe_counts, axis=1) == 1
+    not_own_lobe = lobe_counts[np.arange(len(tree.nodes)), lobes] == 0
+    to_recolor = np.flatnonzero((lobes != 0) & single_successor_lobe & not_own_lobe).tolist()
+    for i in to_recolor:
+        c = int(np.flatnonzero(lobe_counts[i])[0])
+        graph.nodes[tree.nodes[i]]["lobe"] = c
+        print(f"Recoloring node {tree.nodes[i]} from {lobes[i]} to {c}")
+    return bool(to_recolor)
+
+
+def add_new_parent_for_lobe(graph, tree):
     """Recolors a neutral node if it would connect several subtrees of the same color"""
-    successors = dict(nx.bfs_successors(graph, "0"))
     for node in graph.nodes():
         curr_lobe = graph.nodes[node]["lobe"]
         if curr_lobe == 0:
-            if node in successors:
-                lobes = [graph.nodes[succ]["lobe"] for succ in successors[node]]
-                occ = {lobe: lobes.count(lobe) for lobe in lobes}
-                new_lobe = [lobe for lobe, count in occ.items() if 1 < count == max(occ.values())]
+            i = tree.index[node]
+            children = tree.nodes[tree.children_indptr[i] : tree.children_indptr[i + 1]]
+            if children:
+                lobes = [graph.nodes[child]["lobe"] for child in children]
+                occ = Counter(lobes)
+                max_count = max(occ.values(), default=0)
+                new_lobe = [lobe for lobe, count in occ.items() if 1 < count == max_count]
                 if new_lobe:
                     if new_lobe[0] != curr_lobe:
                         graph.nodes[node]["lobe"] = new_lobe[0]
                         print(f"Adding new parent node {node} from {curr_lobe} to {new_lobe[0]}")
 
 
-def recolor_entire_subtree_to_majority_at_level_4_or_5(graph):
+def recolor_entire_subtree_to_majority_at_level_4_or_5(graph, tree):
     """Very drastic measure, recolors subtree at depth at 4 or 5 to the majority
     of its successors. Note that level 5 will be used instead of 4 if its successors
     are of type 4 or 5 (right middle lobe and right upper lobe)
     """
-    all_successor_lobes = get_successor_lobes(graph, return_count=True)
-    root_successors = all_successor_lobes["0"]
+    lobes = get_lobes(graph, tree.nodes)
+    lobe_counts = get_subtree_lobe_counts(tree, lobes)
+    first_positions = get_subtree_lobe_first_positions(tree, lobes, lobe_counts)
+    root_successors = get_ordered_lobe_counts(lobe_counts[0], first_positions[0])
     print(root_successors)
-    for node, successor_lobes in all_successor_lobes.items():
-        if 1 < len(successor_lobes):
-            n = graph.nodes[node]
-
-            # Add exception for the case of lobes 4, 5
-            exc = [lobe_type in successor_lobes for lobe_type in [4, 5]]
-
-            # This if checks whether the current node is on level 4,
-            # or if it is on level 5 if below it are only lobe of type 4 and 5
-            if (n["level"] == 4 and not any(exc)) or (n["level"] == 5 and all(exc)):
-                print(successor_lobes)
-                new_lobe_max = max(successor_lobes, key=lambda key: successor_lobes[key])
-
-                # In case there is more than one with the same count try all of them
-                possible_new_lobes = [
-                    lobe for lobe, _ in sorted(successor_lobes.items(), key=lambda x: x[1], reverse=True)
-                ]
-                # print(possible_new_lobes)
-
-                # If none of the lobes gets entirely removed then proceed
-                for new_lobe in possible_new_lobes:
-                    difference_per_lobe_root_and_curr_node = [
-                        count - successor_lobes.get(lobe, 0)
-                        for lobe, count in root_successors.items()
-                        if lobe != new_lobe
-                    ]
-                    # print(difference_per_lobe_root_and_curr_node)
-                    if all(difference_per_lobe_root_and_curr_node):
-                        set_attribute_recursively(graph, node, "lobe", new_lobe)
-                        print(f"Reassigning all nodes below {node} to {new_lobe}")
-                        break
+    nodes_in_post_order = get_nodes_in_post_order(tree)
+
+    # Add exception for the case of lobes 4, 5
+    exc = [
+        lobe_counts[:, lobe_type] > 0 if lobe_type < lobe_counts.shape[1] else np.zeros(len(tree.nodes), dtype=bool)
+        for lobe_type in [4, 5]
+    ]
+    # This checks whether the current node is on level 4,
+    # or if it is on level 5 if below it are only lobe of type 4 and 5
+    on_level_4 = (tree.level == 4) & ~exc[0] & ~exc[1]
+    on_level_5 = (tree.level == 5) & exc[0] & exc[1]
+    several_lobes = np.count_nonzero(lobe_counts, axis=1) > 1
+    to_check = np.flatnonzero(several_lobes & (on_level_4 | on_level_5))
+
+    # Same order as traversing the tree in post-order
+    for i in to_check[np.argsort(tree.post_order[to_check])].tolist():
+        node = tree.nodes[i]
+        successor_lobes = get_ordered_lobe_counts(lobe_counts[i], first_positions[i])
+        print(successor_lobes)
+
+        # In case there is more than one with the same count try all of them
+        possible_new_lobes = [lobe for lobe, _ in sorted(successor_lobes.items(), key=lambda x: x[1], reverse=True)]
+        # print(possible_new_lobes)
+
+        # If none of the lobes gets entirely removed then proceed
+        for new_lobe in possible_new_lobes:
+            difference_per_lobe_root_and_curr_node = [
+                count - successor_lobes.get(lobe, 0) for lobe, count in root_successors.items() if lobe != new_lobe
+            ]
+            # print(difference_per_lobe_root_and_curr_node)
+            if all(difference_per_lobe_root_and_curr_node):
+                subtree_nodes = nodes_in_post_order[get_subtree_slice(tree, i)]
+                set_attribute_for_nodes(graph, subtree_nodes, "lobe", new_lobe)
+                print(f"Reassigning all nodes below {node} to {new_lobe}")
+                break
 
 
 # ============================================================================
@@ -380,33 +671,29 @@ def main():
     print(f"===== Node Removal =====")
 
     # Run each of these multiple times since they do something on each
-    # iteration. Quit when nothing changes
-    iteration = 0
-    while True:
-        node_count = graph.number_of_nodes()
-        print(f"=== Iteration {iteration} ===")
-
-        remove_minor_edges(graph)
-        straighten_edges(graph)
-        merge_close_nodes(graph)
-        remove_children_without_children(graph)
-
-        iteration += 1
-        if node_count == graph.number_of_nodes():
-            break
+    # iteration. Quit when nothing changes. The BFS successors/predecessors
+    # are kept up to date by the removal methods, so one BFS is enough.
+    # They must not be used after `set_level` though, as it copies the graph
+    # which changes the order of the successors
+    successors, predecessors = get_bfs_maps(graph)
+    group_sizes_summary = get_group_sizes_summary(graph, successors)
+    process_removals(graph, successors, predecessors, group_sizes_summary)
 
     # |>--><-><-><-><-><-><-><-><-><-><-><-><-><--<|
     # |>- Reset attributes from the other script -<|
     # |>--><-><-><-><-><-><-><-><-><-><-><-><-><--<|
 
-    assign_children_count(graph)
-
     graph = set_level(graph)
     graph = set_attribute_to_node(graph, ("level", 2), ("lobe", 0))
     graph = set_attribute_to_node(graph, ("level", 3), ("lobe", 0))
 
     assert nx.is_tree(graph), "ERROR: Graph is no longer a tree!"
 
+    # The tree structure does not change anymore from here on
+    tree = get_tree_arrays(graph)
+    adjacency = get_adjacency_arrays(graph)
+    assign_children_count(graph, tree)
+
     # |>-<-><-><-><-><-><-><-><->-<|
     # |>- Write pre-colored tree -<|
     # |>-<-><-><-><-><-><-><-><->-<|
@@ -422,19 +709,22 @@ def main():
     # |>- Recoloring -<|
     # |>-<-><-><-><->-<|
 
+    # Further iterations can not change anything once both recolor nothing
     for _ in range(5):
-        recolor_if_all_adjacent_have_different_color(graph)
-        recolor_if_successors_all_different_color(graph)
+        recolored = recolor_if_all_adjacent_have_different_color(graph, adjacency)
+        recolored |= recolor_if_successors_all_different_color(graph, tree)
+        if not recolored:
+            break
 
-    recolor_entire_subtree_to_majority_at_level_4_or_5(graph)
-    possibly_make_neutral_above_level_4(graph)
-    add_new_parent_for_lobe(graph)
+    recolor_entire_subtree_to_majority_at_level_4_or_5(graph, tree)
+    possibly_make_neutral_above_level_4(graph, tree)
+    add_new_parent_for_lobe(graph, tree)
 
     # |>-<-><-><-><->-<|
     # |>- Write tree -<|
     # |>-<-><-><-><->-<|
 
-    nx.write_graphml(graph, output_data_path / "tree.graphml")
+    save_graph(graph, output_data_path / "tree.graphml")
 
 
 if __name__ == "__main__":
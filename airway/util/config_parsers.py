@@ -1,5 +1,9 @@
+import os
+import pickle
+import uuid
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Tuple
 
 import yaml
 
@@ -7,16 +11,91 @@ module_path = Path(__file__).parents[2]
 configs_path = module_path / "configs"
 
 
-def get_dict_from_yaml(curr_config_path: Path, ignore_if_does_not_exist=False) -> Dict:
+def get_cache_path(curr_config_path: Path) -> Path:
+    return curr_config_path.with_name(f".{curr_config_path.name}.cache.pickle")
+
+
+def write_cache(cache_path: Path, mtime: int, content: Any):
+    """Atomically writes the parsed content together with the mtime of the parsed file
+
+    If the directory is not writable or the content can not be pickled, the content
+    is simply not cached.
+    """
+    temp_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        # Created like any other file, so the permissions follow the umask
+        fd = os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as cache_file:
+            pickle.dump((mtime, content), cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except Exception:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def load_with_cache(path: Path, load: Callable[[Path], Any], write=True) -> Any:
+    """Loads the file with `load`, using a pickled cache next to it if the file is unchanged
+
+    Parsing text formats is slow compared to unpickling, the cache is invalidated
+    whenever the mtime of the file changes. Without `write` a missing or outdated
+    cache is only read, but not written.
+    """
+    mtime = path.stat().st_mtime_ns
+    cache_path = get_cache_path(path)
+    try:
+        with cache_path.open("rb") as cache_file:
+            cached_mtime, content = pickle.load(cache_file)
+        if cached_mtime == mtime:
+            return content
+    except Exception:
+        # E.g. a missing or corrupt cache, or one written by other library versions
+        pass
+    content = load(path)
+    if write:
+        write_cache(cache_path, mtime, content)
+    return content
+
+
+def load_yaml(curr_config_path: Path) -> Dict:
+    with curr_config_path.open("r") as config_file:
+        return yaml.load(config_file.read(), yaml.FullLoader)
+
+
+def get_dict_from_yaml(curr_config_path: Path, ignore_if_does_not_exist=False, use_cache=False) -> Dict:
+    """Loads the yaml config, with `use_cache` a pickled cache next to it is used
+    if the config is unchanged
+
+    Parsing yaml is slow compared to unpickling, the cache is invalidated
+    whenever the mtime of the yaml file changes.
+    """
     if ignore_if_does_not_exist and not curr_config_path.exists():
         return {}
     assert curr_config_path.exists(), f"Config {curr_config_path} does not exist!"
-    with curr_config_path.open("r") as config_file:
-        return yaml.load(config_file.read(), yaml.FullLoader)
+    if not use_cache:
+        return load_yaml(curr_config_path)
+    return load_with_cache(curr_config_path, load_yaml)
+
+
+def get_mtimes(paths: List[Path]) -> Tuple[Optional[int], ...]:
+    """Returns the mtime of each path, or None if it does not exist"""
+    return tuple(path.stat().st_mtime_ns if path.exists() else None for path in paths)
+
+
+@lru_cache(maxsize=None)
+def get_cached_dict_from_yaml(curr_config_path: Path, mtime: int) -> Dict:
+    """Same as get_dict_from_yaml with use_cache, but keeps the config in memory for
+    as long as the given mtime of the config stays the same. Do not modify the returned dict!
+    """
+    return get_dict_from_yaml(curr_config_path, use_cache=True)
 
 
 def parse_classification_config():
-    classification_config = get_dict_from_yaml(configs_path / "classification.yaml")
+    classification_config = get_dict_from_yaml(configs_path / "classification.yaml", use_cache=True)
     return classification_config
 
 
@@ -32,18 +111,26 @@ def parse_stage_configs():
 
 
 def parse_array_encoding() -> Dict[str, int]:
-    return get_dict_from_yaml(configs_path / "array_encoding.yaml")
+    array_encoding_path = configs_path / "array_encoding.yaml"
+    return dict(get_cached_dict_from_yaml(array_encoding_path, array_encoding_path.stat().st_mtime_ns))
 
 
 def parse_inverted_array_encoding() -> Dict[int, str]:
     return {v: k for k, v in parse_array_encoding()}
 
 
+def get_defaults_paths() -> List[Path]:
+    # Example defaults come first, so that the defaults
+    # written in defaults.yaml overwrite these.
+    return [
+        directory / filename
+        for filename in ["example_defaults.yaml", "defaults.yaml"]
+        for directory in [module_path, configs_path]
+    ]
+
+
 def parse_defaults() -> Dict[str, Any]:
     defaults = {}
-    # Iterate over example defaults first, so that the defaults
-    # written in defaults.yaml overwrite these.
-    for filename in ["example_defaults.yaml", "defaults.yaml"]:
-        for directory in [module_path, configs_path]:
-            defaults.update(get_dict_from_yaml(directory / filename, ignore_if_does_not_exist=True))
+    for defaults_path in get_defaults_paths():
+        defaults.update(get_dict_from_yaml(defaults_path, ignore_if_does_not_exist=True))
     return defaults
@@ -1,14 +1,15 @@
 import sys
+from functools import lru_cache
 from pathlib import Path
 import random
 import string
-from typing import List, Set
+from typing import FrozenSet, List, Optional, Set, Tuple
 
 import markdown
 import yaml
 from weasyprint import HTML
 
-from airway.util.config_parsers import parse_defaults
+from airway.util.config_parsers import get_defaults_paths, get_mtimes, parse_defaults
 
 
 def get_data_paths_from_args(outputs=1, inputs=1):
@@ -59,5 +60,11 @@ def generate_pdf_report(folder_path: Path, file_name_without_ending: str, conten
     a.write_pdf(Path(folder_path) / f"{file_name_without_ending}.pdf", presentational_hints=True)
 
 
+@lru_cache(maxsize=None)
+def parse_ignored_patients(defaults_mtimes: Tuple[Optional[int], ...]) -> FrozenSet[str]:
+    """Parses the ignored patients, `defaults_mtimes` is only used as the cache key"""
+    return frozenset(map(str, parse_defaults().get("ignore_patients", [])))
+
+
 def get_ignored_patients() -> Set[str]:
-    return set(map(str, parse_defaults().get("ignore_patients", [])))
+    return set(parse_ignored_patients(get_mtimes(get_defaults_paths())))
@@ -0,0 +1,62 @@
+import os
+import shutil
+import threading
+
+from airway.util import config_parsers
+from airway.util.config_parsers import get_cache_path, get_dict_from_yaml, parse_array_encoding, write_cache
+
+
+def test_yaml_cache_is_used_and_invalidated(tmp_path, monkeypatch):
+    parsed_paths = []
+    original_load_yaml = config_parsers.load_yaml
+
+    def load_yaml(path):
+        parsed_paths.append(path)
+        return original_load_yaml(path)
+
+    monkeypatch.setattr(config_parsers, "load_yaml", load_yaml)
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("a: 1\n2: [b, c]\n")
+    assert get_dict_from_yaml(config_path, use_cache=True) == {"a": 1, 2: ["b", "c"]}
+    assert get_cache_path(config_path).exists()
+    assert get_dict_from_yaml(config_path, use_cache=True) == {"a": 1, 2: ["b", "c"]}
+    assert parsed_paths == [config_path]
+
+    config_path.write_text("a: 2\n")
+    stat = config_path.stat()
+    os.utime(config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert get_dict_from_yaml(config_path, use_cache=True) == {"a": 2}
+    assert parsed_paths == [config_path, config_path]
+
+
+def test_yaml_is_not_cached_by_default(tmp_path):
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("a: 1\n")
+    assert get_dict_from_yaml(config_path) == {"a": 1}
+    assert list(tmp_path.iterdir()) == [config_path]
+
+
+def test_cache_permissions_follow_umask(tmp_path):
+    umask = os.umask(0o027)
+    try:
+        write_cache(tmp_path / ".config.yaml.cache.pickle", 0, {"a": 1})
+    finally:
+        os.umask(umask)
+    assert (tmp_path / ".config.yaml.cache.pickle").stat().st_mode & 0o777 == 0o640
+
+
+def test_missing_config_is_ignored(tmp_path):
+    assert get_dict_from_yaml(tmp_path / "missing.yaml", ignore_if_does_not_exist=True) == {}
+
+
+def test_failed_cache_write_leaves_no_files(tmp_path):
+    write_cache(tmp_path / ".config.yaml.cache.pickle", 0, threading.Lock())
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_array_encoding_copy_does_not_modify_cache(tmp_path, monkeypatch):
+    shutil.copy(config_parsers.configs_path / "array_encoding.yaml", tmp_path)
+    monkeypatch.setattr(config_parsers, "configs_path", tmp_path)
+    encoding = parse_array_encoding()
+    encoding["Empty"] = -1
+    assert parse_array_encoding()["Empty"] == 0
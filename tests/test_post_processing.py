@@ -0,0 +1,375 @@
+import random
+
+import networkx as nx
+import pytest
+
+from airway.tree_extraction.post_processing import (
+    add_new_parent_for_lobe,
+    assign_children_count,
+    bfs,
+    get_adjacency_arrays,
+    get_bfs_maps,
+    get_group_sizes_summary,
+    get_lobes,
+    get_nodes_in_post_order,
+    get_ordered_lobe_counts,
+    get_subtree_lobe_counts,
+    get_subtree_lobe_first_positions,
+    get_subtree_slice,
+    get_tree_arrays,
+    load_graph,
+    merge_close_nodes,
+    possibly_make_neutral_above_level_4,
+    recolor_entire_subtree_to_majority_at_level_4_or_5,
+    process_removals,
+    recolor_if_all_adjacent_have_different_color,
+    recolor_if_successors_all_different_color,
+    remove_children_without_children,
+    remove_minor_edges,
+    save_graph,
+    set_attribute_for_nodes,
+    straighten_edges,
+)
+from airway.util.config_parsers import get_cache_path
+
+
+def make_tree(edges, lobes, levels=None):
+    """Builds a tree from (parent, child) edges, the lobes and levels are given per node"""
+    graph = nx.Graph()
+    graph.add_node("0")
+    graph.add_edges_from(edges)
+    depths = nx.single_source_shortest_path_length(graph, "0")
+    for node in graph.nodes:
+        graph.nodes[node]["lobe"] = lobes.get(node, 0)
+        graph.nodes[node]["level"] = (levels or depths)[node]
+    return graph
+
+
+def random_tree(seed):
+    """Random tree whose adjacency order differs from the order the nodes were added in"""
+    r = random.Random(seed)
+    edges = [(str(r.randrange(i)), str(i)) for i in range(1, r.randint(1, 60))]
+    r.shuffle(edges)
+    graph = nx.Graph()
+    graph.add_node("0")
+    graph.add_edges_from(edges)
+    for node in graph.nodes:
+        graph.nodes[node].update(
+            lobe=r.choice([0, 1, 1, 2, 2, 3, 4, 5]),
+            level=r.choice([2, 3, 4, 4, 5, 5, 6]),
+            group_size=r.randint(1, 12),
+            x=r.uniform(0, 20),
+            y=r.uniform(0, 20),
+            z=r.uniform(0, 20),
+        )
+    for fr, to in graph.edges:
+        graph[fr][to]["weight"] = r.uniform(0.5, 20)
+        graph[fr][to]["group_sizes"] = " ".join(str(r.randint(1, 60)) for _ in range(r.randint(1, 12)))
+    return graph
+
+
+def reference_successor_lobes(graph):
+    """Counts the lobes of each subtree (including its root) recursively, the
+    subtrees and the lobes in each of them are in the order they are finished
+    """
+    successors = dict(nx.bfs_successors(graph, "0"))
+    all_successor_lobes = {}
+
+    def count_lobes(node):
+        lobes = {}
+        for succ in successors.get(node, []):
+            for lobe, count in count_lobes(succ).items():
+                lobes[lobe] = lobes.get(lobe, 0) + count
+        if graph.nodes[node]["lobe"] != 0:
+            lobes[graph.nodes[node]["lobe"]] = lobes.get(graph.nodes[node]["lobe"], 0) + 1
+        all_successor_lobes[node] = lobes
+        return lobes
+
+    count_lobes("0")
+    return all_successor_lobes
+
+
+def reference_recolor_if_all_adjacent_have_different_color(graph):
+    root_successors = reference_successor_lobes(graph)["0"]
+    n = graph.nodes
+    for node in graph.nodes:
+        if n[node]["lobe"] != 0:
+            adjacent_lobes = {n[adj]["lobe"] for adj in graph[node] if n[adj]["lobe"] != 0}
+            if len(adjacent_lobes) == 1:
+                surrounding_lobe = adjacent_lobes.pop()
+                if surrounding_lobe != n[node]["lobe"] and root_successors[n[node]["lobe"]] > 1:
+                    n[node]["lobe"] = surrounding_lobe
+
+
+def reference_recolor_if_successors_all_different_color(graph):
+    for node, successor_lobes in reference_successor_lobes(graph).items():
+        curr_lobe = graph.nodes[node]["lobe"]
+        if curr_lobe != 0 and len(successor_lobes) == 1 and curr_lobe not in successor_lobes:
+            graph.nodes[node]["lobe"] = list(successor_lobes)[0]
+
+
+def reference_possibly_make_neutral_above_level_4(graph):
+    for node, successor_lobes in reference_successor_lobes(graph).items():
+        if graph.nodes[node]["level"] <= 4 and graph.nodes[node]["lobe"] != 0 and len(successor_lobes) > 1:
+            graph.nodes[node]["lobe"] = 0
+
+
+def reference_recolor_entire_subtree_to_majority_at_level_4_or_5(graph):
+    bfs_tree = nx.bfs_tree(graph, "0")
+    all_successor_lobes = reference_successor_lobes(graph)
+    root_successors = all_successor_lobes["0"]
+    for node, successor_lobes in all_successor_lobes.items():
+        exc = [lobe_type in successor_lobes for lobe_type in [4, 5]]
+        level = graph.nodes[node]["level"]
+        if 1 < len(successor_lobes) and ((level == 4 and not any(exc)) or (level == 5 and all(exc))):
+            for new_lobe, _ in sorted(successor_lobes.items(), key=lambda x: x[1], reverse=True):
+                differences = [
+                    count - successor_lobes.get(lobe, 0) for lobe, count in root_successors.items() if lobe != new_lobe
+                ]
+                if all(differences):
+                    for subtree_node in nx.dfs_preorder_nodes(bfs_tree, node):
+                        graph.nodes[subtree_node]["lobe"] = new_lobe
+                    break
+
+
+def reference_add_new_parent_for_lobe(graph):
+    successors = dict(nx.bfs_successors(graph, "0"))
+    for node in graph.nodes:
+        if graph.nodes[node]["lobe"] == 0 and node in successors:
+            lobes = [graph.nodes[succ]["lobe"] for succ in successors[node]]
+            occ = {lobe: lobes.count(lobe) for lobe in lobes}
+            new_lobe = [lobe for lobe, count in occ.items() if 1 < count == max(occ.values())]
+            if new_lobe:
+                graph.nodes[node]["lobe"] = new_lobe[0]
+
+
+def get_lobe_dict(graph):
+    return dict(graph.nodes(data="lobe"))
+
+
+def assert_bfs_maps_are_up_to_date(graph, successors, predecessors):
+    """The order of the successors may differ, as merged edges are appended"""
+    expected_successors = dict(nx.bfs_successors(graph, "0"))
+    assert {node: set(succ) for node, succ in successors.items()} == {
+        node: set(succ) for node, succ in expected_successors.items()
+    }
+    assert predecessors == dict(nx.bfs_predecessors(graph, "0"))
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_bfs_matches_networkx(seed):
+    graph = random_tree(seed)
+    nodes, index, indptr, indices = get_adjacency_arrays(graph)
+    order, parent, depth = bfs(indptr, indices, index["0"])
+    assert [(nodes[parent[i]], nodes[i]) for i in order[1:]] == list(nx.bfs_edges(graph, "0"))
+    assert dict(zip(nodes, depth.tolist())) == nx.single_source_shortest_path_length(graph, "0")
+
+    successors, predecessors = get_bfs_maps(graph)
+    # The root is kept even without successors
+    assert list(successors.items()) == list({"0": [], **dict(nx.bfs_successors(graph, "0"))}.items())
+    assert predecessors == dict(nx.bfs_predecessors(graph, "0"))
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_bfs_maps_are_kept_up_to_date(seed):
+    graph = random_tree(seed)
+    successors, predecessors = get_bfs_maps(graph)
+    group_sizes_summary = get_group_sizes_summary(graph, successors)
+    for _ in range(3):
+        for removal_method in [remove_minor_edges, straighten_edges, merge_close_nodes]:
+            node_count = len(graph)
+            assert removal_method(graph, successors, predecessors, group_sizes_summary) == node_count - len(graph)
+            assert_bfs_maps_are_up_to_date(graph, successors, predecessors)
+        node_count = len(graph)
+        assert remove_children_without_children(graph, successors, predecessors) == node_count - len(graph)
+        assert_bfs_maps_are_up_to_date(graph, successors, predecessors)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_group_sizes_summary_is_kept_up_to_date(seed):
+    graph = random_tree(seed)
+    successors, predecessors = get_bfs_maps(graph)
+    group_sizes_summary = get_group_sizes_summary(graph, successors)
+    process_removals(graph, successors, predecessors, group_sizes_summary)
+    for fr, to, data in graph.edges(data=True):
+        nums = list(map(int, data["group_sizes"].split()))
+        edge = (fr, to) if predecessors.get(to) == fr else (to, fr)
+        assert group_sizes_summary[edge] == (len(nums), sum(nums))
+        assert set(data) == {"weight", "group_sizes"}
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_shared_bfs_gives_same_tree_as_bfs_per_iteration(seed):
+    graph = random_tree(seed)
+    successors, predecessors = get_bfs_maps(graph)
+    process_removals(graph, successors, predecessors, get_group_sizes_summary(graph, successors))
+
+    expected = random_tree(seed)
+    while True:
+        node_count = len(expected)
+        expected_successors, expected_predecessors = get_bfs_maps(expected)
+        expected_summary = get_group_sizes_summary(expected, expected_successors)
+        for removal_method in [remove_minor_edges, straighten_edges, merge_close_nodes]:
+            removal_method(expected, expected_successors, expected_predecessors, expected_summary)
+        remove_children_without_children(expected, expected_successors, expected_predecessors)
+        if node_count == len(expected):
+            break
+
+    assert set(graph.nodes) == set(expected.nodes)
+    assert {frozenset(edge) for edge in graph.edges} == {frozenset(edge) for edge in expected.edges}
+
+
+def test_root_without_successors_is_kept():
+    graph = nx.Graph([("0", "1"), ("1", "2")])
+    successors, predecessors = get_bfs_maps(graph)
+    for _ in range(3):
+        remove_children_without_children(graph, successors, predecessors)
+    assert list(graph.nodes) == ["0"]
+    assert successors == {"0": []}
+    assert predecessors == {}
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_tree_arrays_match_networkx(seed):
+    graph = random_tree(seed)
+    tree = get_tree_arrays(graph)
+    successors = dict(nx.bfs_successors(graph, "0"))
+    bfs_tree = nx.bfs_tree(graph, "0")
+    assert tree.nodes == ["0"] + [node for _, node in nx.bfs_edges(graph, "0")]
+    assert [tree.index[node] for node in tree.nodes] == list(range(len(tree.nodes)))
+    depths = nx.single_source_shortest_path_length(graph, "0")
+    for i, node in enumerate(tree.nodes):
+        assert tree.depth[i] == depths[node]
+        assert tree.nodes[tree.children_indptr[i] : tree.children_indptr[i + 1]] == successors.get(node, [])
+        if i:
+            assert tree.nodes[tree.parent[i]] in graph[node]
+        assert tree.subtree_size[i] == len(nx.descendants(bfs_tree, node)) + 1
+    post_order = list(nx.dfs_postorder_nodes(graph, "0"))
+    assert tree.post_order.tolist() == [post_order.index(node) for node in tree.nodes]
+    nodes_in_post_order = get_nodes_in_post_order(tree)
+    assert nodes_in_post_order == post_order
+    for i, node in enumerate(tree.nodes):
+        subtree_nodes = nodes_in_post_order[get_subtree_slice(tree, i)]
+        assert set(subtree_nodes) == nx.descendants(bfs_tree, node) | {node}
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_subtree_lobe_counts_match_recursion(seed):
+    graph = random_tree(seed)
+    tree = get_tree_arrays(graph)
+    lobes = get_lobes(graph, tree.nodes)
+    lobe_counts = get_subtree_lobe_counts(tree, lobes)
+    first_positions = get_subtree_lobe_first_positions(tree, lobes, lobe_counts)
+    for node, expected in reference_successor_lobes(graph).items():
+        i = tree.index[node]
+        # Including the order in which the lobes are encountered
+        assert list(get_ordered_lobe_counts(lobe_counts[i], first_positions[i]).items()) == list(expected.items())
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_traversals_match_recursion(seed):
+    graph = random_tree(seed)
+    tree = get_tree_arrays(graph)
+    bfs_tree = nx.bfs_tree(graph, "0")
+
+    assign_children_count(graph, tree)
+    for node in graph.nodes:
+        assert graph.nodes[node]["successor_count"] == len(nx.descendants(bfs_tree, node))
+
+    node = random.Random(seed).choice(list(graph.nodes))
+    subtree_nodes = get_nodes_in_post_order(tree)[get_subtree_slice(tree, tree.index[node])]
+    set_attribute_for_nodes(graph, subtree_nodes, "lobe", 7)
+    assert {n for n in graph.nodes if graph.nodes[n]["lobe"] == 7} == nx.descendants(bfs_tree, node) | {node}
+
+
+def test_recolor_entire_subtree_tie_uses_first_lobe_in_post_order():
+    # Node 1 has two nodes each of lobe 1 and 2 below it, lobe 2 comes first in post-order
+    edges = [("0", "1"), ("1", "5"), ("1", "2"), ("1", "3"), ("1", "4"), ("0", "6"), ("0", "7")]
+    lobes = {"5": 2, "2": 1, "3": 1, "4": 2, "6": 1, "7": 2}
+    levels = {"0": 0, "1": 4, "2": 5, "3": 5, "4": 5, "5": 5, "6": 4, "7": 4}
+    graph, reference = make_tree(edges, lobes, levels), make_tree(edges, lobes, levels)
+    recolor_entire_subtree_to_majority_at_level_4_or_5(graph, get_tree_arrays(graph))
+    reference_recolor_entire_subtree_to_majority_at_level_4_or_5(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference)
+    assert [graph.nodes[node]["lobe"] for node in "12345"] == [2, 2, 2, 2, 2]
+
+
+def test_add_new_parent_for_lobe_tie_uses_first_child():
+    edges = [("0", "1"), ("1", "5"), ("1", "2"), ("1", "3"), ("1", "4")]
+    graph = make_tree(edges, {"5": 2, "2": 1, "3": 1, "4": 2})
+    add_new_parent_for_lobe(graph, get_tree_arrays(graph))
+    assert graph.nodes["1"]["lobe"] == 2
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_recoloring_matches_reference(seed):
+    # Not graph.copy(), as copying changes the order of the adjacency
+    graph, reference = random_tree(seed), random_tree(seed)
+
+    tree = get_tree_arrays(graph)
+
+    recolor_if_all_adjacent_have_different_color(graph, get_adjacency_arrays(graph))
+    reference_recolor_if_all_adjacent_have_different_color(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference)
+
+    recolor_if_successors_all_different_color(graph, tree)
+    reference_recolor_if_successors_all_different_color(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference)
+
+    recolor_entire_subtree_to_majority_at_level_4_or_5(graph, tree)
+    reference_recolor_entire_subtree_to_majority_at_level_4_or_5(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference)
+
+    possibly_make_neutral_above_level_4(graph, tree)
+    reference_possibly_make_neutral_above_level_4(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference)
+
+    add_new_parent_for_lobe(graph, tree)
+    reference_add_new_parent_for_lobe(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference)
+
+
+def test_recolor_if_all_adjacent_have_different_color_sees_new_colors():
+    # Node 1 is recolored to 1 first, hence node 2 does not only have lobe 2 next to it anymore
+    edges = [("0", "1"), ("1", "2"), ("2", "3")]
+    lobes = {"1": 2, "2": 1, "3": 2}
+    graph, reference = make_tree(edges, lobes), make_tree(edges, lobes)
+    assert recolor_if_all_adjacent_have_different_color(graph, get_adjacency_arrays(graph))
+    reference_recolor_if_all_adjacent_have_different_color(reference)
+    assert get_lobe_dict(graph) == get_lobe_dict(reference) == {"0": 0, "1": 1, "2": 1, "3": 1}
+
+
+def test_saved_graph_is_loaded_from_cache(tmp_path):
+    graph = nx.Graph(patient=3)
+    graph.add_node("0", lobe=0, x=1.5)
+    graph.add_edge("0", "1", weight=2.0)
+    graph_path = tmp_path / "tree.graphml"
+    save_graph(graph, graph_path)
+    assert get_cache_path(graph_path).exists()
+
+    loaded = load_graph(graph_path)
+    assert loaded.graph == graph.graph
+    assert list(loaded.nodes(data=True)) == list(graph.nodes(data=True))
+    assert list(loaded.edges(data=True)) == list(graph.edges(data=True))
+
+    get_cache_path(graph_path).unlink()
+    assert list(load_graph(graph_path).nodes(data=True)) == list(graph.nodes(data=True))
+
+
+def test_loading_graph_does_not_write_cache(tmp_path):
+    graph = nx.Graph()
+    graph.add_edge("0", "1", weight=2.0)
+    graph_path = tmp_path / "tree.graphml"
+    nx.write_graphml(graph, graph_path)
+    assert list(load_graph(graph_path).edges(data=True)) == [("0", "1", {"weight": 2.0})]
+    assert list(tmp_path.iterdir()) == [graph_path]
+
+
+def test_unreadable_cache_falls_back_to_graphml(tmp_path):
+    graph = nx.Graph()
+    graph.add_edge("0", "1", weight=2.0)
+    graph_path = tmp_path / "tree.graphml"
+    save_graph(graph, graph_path)
+    # Unpickling this fails with an AttributeError, as if written by another networkx version
+    get_cache_path(graph_path).write_bytes(b"cnetworkx\nNoSuchGraph\n.")
+    assert list(load_graph(graph_path).edges(data=True)) == [("0", "1", {"weight": 2.0})]